@@ -1,6 +1,122 @@
 import numpy as np
-import pylab as pl
-import pdb
+import scipy.fft
+import warnings
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+	import pyfftw
+except ImportError:
+	pyfftw = None
+
+try:
+	import cupy
+except ImportError:
+	cupy = None
+
+try:
+	from numba import njit
+	_HAVE_NUMBA = True
+except ImportError:
+	# without numba the kernels below that are array expressions run as
+	# plain numpy; the loop kernels are skipped (see _HAVE_NUMBA).
+	_HAVE_NUMBA = False
+	def njit(*args,**kwargs):
+		if len(args) == 1 and callable(args[0]):
+			return args[0]
+		return lambda f: f
+
+# eager signatures for the contiguous layouts KS produces, double and single
+# precision, single (1d) or batched (2d) state; compiled once at import and
+# cached on disk, so the first step pays no JIT warm-up.
+_NL_SIGS = [
+	"void(c16[::1],c16[::1],c16[::1])",
+	"void(c16[::1],c16[:,::1],c16[:,::1])",
+	"void(c8[::1],c8[::1],c8[::1])",
+	"void(c8[::1],c8[:,::1],c8[:,::1])",
+]
+_FUSE_SIGS = [
+	"void(c16[::1],f8[::1],c16[::1],c16[::1],c16[::1])",
+	"void(c16[:,::1],f8[::1],c16[::1],c16[:,::1],c16[:,::1])",
+	"void(c8[::1],f4[::1],c8[::1],c8[::1],c8[::1])",
+	"void(c8[:,::1],f4[::1],c8[::1],c8[:,::1],c8[:,::1])",
+]
+
+@njit(_NL_SIGS,fastmath=True,parallel=False,cache=True)
+def _nl_multiply(ik,spec_in,spec_out):
+	# spec_out = -0.5*ik*spec_in, the spectral form of -u*u_x
+	spec_out[...] = -0.5*ik*spec_in
+
+_POWER_SIGS = [
+	"void(c16[:,::1],f8[::1],f8,f8[::1])",
+	"void(c8[:,::1],f8[::1],f8,f8[::1])",
+]
+
+@njit(_POWER_SIGS,fastmath=True,parallel=False,cache=True)
+def _weighted_power(xspec,w,nyq,out):
+	# out[b] = sum_k w_k*|xspec[b,k]|**2 - nyq*Im(xspec[b,-1])**2, one value
+	# per row, reduced in a single loop without temporaries
+	for b in range(xspec.shape[0]):
+		e = 0.0
+		for k in range(xspec.shape[1]):
+			re = xspec[b,k].real
+			im = xspec[b,k].imag
+			e += w[k]*(re*re + im*im)
+		im = xspec[b,-1].imag
+		out[b] = e - nyq*im*im
+
+_ACC_SIGS = [
+	"void(f8[:,::1],c16[:,::1])",
+	"void(f8[:,::1],c8[:,::1])",
+]
+
+@njit(_ACC_SIGS,fastmath=True,parallel=False,cache=True)
+def _accumulate_power(vspec,xspec):
+	# vspec += |xspec|**2 in a single pass, without the np.abs(xspec)**2
+	# temporaries
+	for b in range(xspec.shape[0]):
+		for k in range(xspec.shape[1]):
+			re = xspec[b,k].real
+			im = xspec[b,k].imag
+			vspec[b,k] += re*re + im*im
+
+if cupy is not None:
+	# device version of _fuse_nl_rk, a single fused elementwise kernel
+	@cupy.fuse()
+	def _fuse_nl_rk_gpu(xspec_save,P,R,spec_x2):
+		return P*xspec_save + R*spec_x2
+
+@njit(_FUSE_SIGS,fastmath=True,parallel=False,cache=True)
+def _fuse_nl_rk(xspec_save,P,R,spec_x2,out):
+	# one RK3 stage: explicit step of the nonlinear term fused with the
+	# implicit trapezoidal adjustment of the linear term. R = -0.5*ik*Q
+	# already folds in the derivative, so spec_x2 = rfft(u**2) is used as is
+	# and the spectrum is written once.
+	out[...] = P*xspec_save + R*spec_x2
+
+# initial conditions on the grid xx = linspace(0,L,N); theta = xx*(2*pi/L)
+# spans one period, a single scalar factor instead of per-term divides.
+
+def _ic_default(xx,L,N):
+	theta = xx*(2*np.pi/L)
+	return np.cos(2*theta)*(1.0+np.sin(theta))
+
+def _ic_random(xx,L,N):
+	return 0.1*np.random.rand(N)
+
+def _ic_sine(xx,L,N):
+	return np.sin(4*np.pi/L*xx)
+
+_ic_table = {'default': _ic_default, 'random': _ic_random, 'sine': _ic_sine}
+
+def _initial_state(initial_condition,xx,L,N):
+	# a name from _ic_table or an explicit array, shape (N,) or (B,N)
+	if isinstance(initial_condition,str):
+		if initial_condition not in _ic_table:
+			raise ValueError("unknown initial_condition %r, expected one of %s"
+			                 % (initial_condition,", ".join(sorted(_ic_table))))
+		return _ic_table[initial_condition](xx,L,N)
+	return np.array(initial_condition,dtype=np.float64)
 
 class KS(object):
 	#
@@ -8,89 +124,357 @@ class KS(object):
 	# u_t + u*u_x + u_xx + diffusion*u_xxxx = 0, periodic BCs on [0,2*pi*L].
 	# time step dt with N fourier collocation points.
 	
-	def __init__(self,L=16,N=128,dt=0.5,diffusion=1.0):
+	def __init__(self,L=16,N=128,dt=0.5,diffusion=1.0,workers=-1,fftw=True,initial_condition='default',
+	             dtype=np.float64,backend='numpy',fast_len=False):
+		
+		# with fast_len=True a slow FFT length N is rounded up to the next
+		# 2^a 3^b 5^c size; the grid, xx and wavenums all follow the new N
+		# and array initial conditions are spectrally interpolated onto it.
+		n_req = N
+		nfast = scipy.fft.next_fast_len(N,real=True)
+		if nfast != N:
+			if fast_len:
+				warnings.warn("N=%d is not a fast FFT length, using N=%d" % (N,nfast))
+				N = nfast
+			else:
+				warnings.warn("N=%d is not a fast FFT length, N=%d would be faster (fast_len=True)" % (N,nfast))
 		
 		self.L = L 
 		self.n = N 
-		self.dt = dt
 		self.diffusion = diffusion
+		self.workers = workers  # threads used by scipy.fft (-1 = all cores)
+		
+		# np.float32 halves the memory traffic of the transforms. The dynamics
+		# are chaotic, so a float32 trajectory leaves the float64 one after a
+		# few hundred steps; it keeps the statistics (energy, spectra), not
+		# pointwise agreement. Not the default.
+		self.dtype  = np.dtype(dtype)
+		self.cdtype = np.result_type(self.dtype,np.complex64)
 		
-		kk = N*np.fft.fftfreq(N)[0:int((N/2)+1)]  # wave numbers
+		# backend='cupy' keeps the state and all operators on the GPU and
+		# runs the transforms through cuFFT (plans are cached by cupy).
+		if backend == 'cupy':
+			if cupy is None:
+				raise ImportError("backend='cupy' requires cupy")
+			self._xp = cupy
+			fftw = False
+		elif backend == 'numpy':
+			self._xp = np
+		else:
+			raise ValueError("unknown backend %r" % backend)
 		
-		self.wavenums = N*np.fft.fftfreq(N)[0:int((N/2)+1)]
-		k  = kk.astype(np.float)/L
+		kk = np.arange(N//2+1,dtype=np.float64)  # wave numbers
 		
-		self.ik    = 1j*k                   # spectral derivative operator
-		self.lin   = k**2 - diffusion*k**4  # Fourier multipliers for linear term
+		self.wavenums = kk
+		k  = self._xp.asarray(kk/L)
+		
+		self.ik    = (1j*k).astype(self.cdtype)                   # spectral derivative operator
+		self.lin   = (k**2 - diffusion*k**4).astype(self.dtype)  # Fourier multipliers for linear term
+		self.dt    = dt                     # also builds the RK3 propagators
+		
+		# Parseval weights for get_energy: rfft keeps k >= 0 only, so every
+		# mode but k=0 (and k=N/2 for even N) stands for a +-k pair.
+		w = np.full(N//2+1,2.0)
+		w[0] = 1.0
+		if N % 2 == 0:
+			w[-1] = 1.0
+		self._energy_w = self._xp.asarray(w*(2*np.pi*L)/N**2)
+		# irfft drops the imaginary part of the Nyquist mode (even N only)
+		self._energy_nyq = float(w[-1]*(2*np.pi*L)/N**2) if N % 2 == 0 else 0.0
 
 		xx = np.linspace(0,L,N)		
 		self.xx = xx
         
-		#x = 0.1*np.random.rand(N)
-		x = np.cos(4*np.pi*xx/L)*(1.0+np.sin(2*np.pi*xx/L))
-		#x = np.sin(4*np.pi*xx/L)
-        # remove mean from initial condition.
-        
-		#pdb.set_trace()
-
-		self.x = x - x.mean()
-        	
-        #spectral space variable
+		x = _initial_state(initial_condition,xx,L,N)
+		if x.shape[-1] != N:
+			if x.shape[-1] != n_req:
+				raise ValueError("initial_condition must have length N=%d" % n_req)
+			x = scipy.fft.irfft(scipy.fft.rfft(x,axis=-1),n=N,axis=-1)*(N/n_req)
+		x = self._xp.ascontiguousarray(self._xp.asarray(x),dtype=self.dtype)
+		
+		# persistent FFTW plans bound to aligned work buffers, if available.
+		# planning with FFTW_MEASURE scribbles on the buffers, so do it first.
+		self._fft = self._ifft = None
+		if fftw and pyfftw is not None:
+			threads = os.cpu_count() if workers < 0 else workers
+			self._real_buf = pyfftw.empty_aligned(x.shape,dtype=self.dtype)
+			self._spec_buf = pyfftw.empty_aligned(x.shape[:-1]+(N//2+1,),dtype=self.cdtype)
+			self._fft  = pyfftw.FFTW(self._real_buf,self._spec_buf,direction='FFTW_FORWARD',
+			                         flags=('FFTW_MEASURE',),threads=threads)
+			self._ifft = pyfftw.FFTW(self._spec_buf,self._real_buf,direction='FFTW_BACKWARD',
+			                         flags=('FFTW_MEASURE',),threads=threads)
+		
+		#spectral space variable
+		
+		# remove mean from initial condition by zeroing the k=0 mode. ik and
+		# lin both vanish at k=0, so step() conserves the mean exactly and
+		# it never needs to be projected out again.
+		self.xspec = self._rfft(x)
+		self.xspec[...,0] = 0.0
+		self._x = None  # physical space view of xspec, built on demand
+		self._nl = self._xp.empty_like(self.xspec)  # output of nlterm, reused each call
+		self._xspec_save = self._xp.empty_like(self.xspec)  # start-of-step state
+	
+	@property
+	def x(self):
+		# cached irfft of xspec; read only, since a write to it would not
+		# reach xspec. Assign ks.x = ... to set the state instead.
+		if self._x is None:
+			self._x = self._irfft(self.xspec)
+			if self._xp is np:
+				self._x.flags.writeable = False
+		return self._x
+	
+	@x.setter
+	def x(self,x):
+		self.xspec = self._rfft(self._xp.ascontiguousarray(self._xp.asarray(x),dtype=self.dtype))
+	
+	@property
+	def xspec(self):
+		# spectral state, updated in place by step()/step_n() on the numpy
+		# backend; copy it to keep a snapshot.
+		return self._xspec
+	
+	@xspec.setter
+	def xspec(self,xspec):
+		# always a copy: step() overwrites the state in place, which must
+		# not reach the caller's array.
+		self._xspec = self._xp.array(xspec,dtype=self.cdtype,order='C')
+		self._x = None
+	
+	@property
+	def dt(self):
+		return self._dt
+	
+	@dt.setter
+	def dt(self,dt):
+		
+		# stage n of the RK3 update advances by dt_n = dt/(3-n) and reads
+		#   xspec = P_n*xspec_save + Q_n*nlterm(xspec)
+		# with P_n = (1 + lin*dt_n/2)/(1 - lin*dt_n/2), Q_n = dt_n/(1 - lin*dt_n/2).
+		# R_n = -0.5*ik*Q_n lets the stage take rfft(u**2) directly.
+		# lin and dt are fixed between steps, so build them once here.
+		
+		self._dt = dt
+		self._P = self._xp.empty((3,)+self.lin.shape,dtype=self.lin.dtype)
+		self._Q = self._xp.empty((3,)+self.lin.shape,dtype=self.lin.dtype)
+		for n in range(3):
+			d = dt/(3-n)
+			denom = 1.0 - 0.5*self.lin*d
+			self._P[n] = (1.0 + 0.5*self.lin*d)/denom
+			self._Q[n] = d/denom
+		self._R = (-0.5*self.ik*self._Q).astype(self.cdtype)
+		self._stages = tuple(zip(self._P,self._R))
+	
+	def _rfft(self,x):
+		
+		if self._xp is not np:
+			return self._xp.fft.rfft(x,axis=-1)
+		if self._fft is None:
+			return scipy.fft.rfft(x,axis=-1,workers=self.workers)
+		self._real_buf[...] = x
+		return self._fft().copy()
+	
+	def _irfft(self,xspec):
 		
-		#pdb.set_trace()
-		self.xspec = np.fft.rfft(self.x,axis=-1)
+		if self._xp is not np:
+			return self._xp.fft.irfft(xspec,n=self.n,axis=-1)
+		if self._ifft is None:
+			return scipy.fft.irfft(xspec,n=self.n,axis=-1,workers=self.workers)
+		self._spec_buf[...] = xspec
+		return self._ifft().copy()
     
+	def _spec_x2(self,xspec):
+		
+		# rfft(u**2) for u = irfft(xspec). The result may be a work buffer
+		# overwritten by the next transform.
+		
+		if self._xp is not np:
+			x = self._xp.fft.irfft(xspec,n=self.n,axis=-1)
+			x *= x
+			spec = self._xp.fft.rfft(x,axis=-1)
+		elif self._fft is None:
+			# square in place and let pocketfft reuse x as its work buffer.
+			x = scipy.fft.irfft(xspec,n=self.n,axis=-1,workers=self.workers)
+			np.multiply(x,x,out=x)
+			spec = scipy.fft.rfft(x,axis=-1,overwrite_x=True,workers=self.workers)
+		else:
+			# square in place in the FFTW real buffer.
+			self._spec_buf[...] = xspec
+			x = self._ifft()
+			np.multiply(x,x,out=x)
+			spec = self._fft()
+		return spec
+	
 	def nlterm(self,xspec):
 		
-		x = np.fft.irfft(xspec,axis=-1)
+		# returns a buffer owned by the model, overwritten on the next call.
 		
-		return -0.5*self.ik*np.fft.rfft(x**2,axis=-1)
+		spec = self._spec_x2(xspec)
+		if self._xp is np:
+			_nl_multiply(self.ik,spec,self._nl)
+		else:
+			self._nl[...] = -0.5*self.ik*spec
+		return self._nl
     
 	def step(self):
 		
-		# semi-implicit third-order runge kutta update.
-		
-		self.xspec = np.fft.rfft(self.x,axis=-1)
+		# semi-implicit third-order runge kutta update. The state lives in
+		# xspec between steps and, on the numpy backend, is overwritten in
+		# place (references to ks.xspec see the new state); x is only
+		# transformed back when read.
 		
-		xspec_save = self.xspec.copy()
+		spec_x2 = self._spec_x2
+		xspec = self.xspec
+		xspec_save = self._xspec_save
+		self._xp.copyto(xspec_save,xspec)
         
-		for n in range(3):
-			
-			dt = self.dt/(3-n)
-			# explicit RK3 step for nonlinear term
-			
-			self.xspec = xspec_save + dt*self.nlterm(self.xspec)
-			# implicit trapezoidal adjustment for linear term
-			
-			self.xspec = (self.xspec+0.5*self.lin*dt*xspec_save)/(1.-0.5*self.lin*dt)
+		# explicit RK3 step for nonlinear term, implicit trapezoidal
+		# adjustment for linear term. The stages differ only in their
+		# (P_n,R_n) pair, so all three run as one loop over the prebuilt
+		# pairs, with the backend chosen once per step.
+		
+		if self._xp is np:
+			for P,R in self._stages:
+				_fuse_nl_rk(xspec_save,P,R,spec_x2(xspec),xspec)
+		else:
+			for P,R in self._stages:
+				xspec = _fuse_nl_rk_gpu(xspec_save,P,R,spec_x2(xspec))
+			self._xspec = xspec
 
-		self.x = np.fft.irfft(self.xspec,axis=-1)
+		self._x = None
+
+	def step_n(self,nsteps,energies=None):
+		
+		# nsteps calls of step() with the backend dispatch and attribute
+		# lookups done once; x is left stale until read, as after step().
+		# If given, energies[i] receives get_energy() after step i; it must be
+		# an array of the model's backend with room for nsteps entries, each
+		# of the batch size for KSBatch.
+		
+		spec_x2 = self._spec_x2
+		xspec = self.xspec
+		xspec_save = self._xspec_save
+		stages = self._stages
+		copyto = self._xp.copyto
+		
+		if self._xp is np:
+			for i in range(nsteps):
+				copyto(xspec_save,xspec)
+				for P,R in stages:
+					_fuse_nl_rk(xspec_save,P,R,spec_x2(xspec),xspec)
+				if energies is not None:
+					energies[i] = self.get_energy()
+		else:
+			for i in range(nsteps):
+				copyto(xspec_save,xspec)
+				for P,R in stages:
+					xspec = _fuse_nl_rk_gpu(xspec_save,P,R,spec_x2(xspec))
+				if energies is not None:
+					self._xspec = xspec
+					energies[i] = self.get_energy()
+			self._xspec = xspec
+		
+		self._x = None
+
+	def to_host(self):
+		
+		# x as a numpy array, copied off the device for backend='cupy'
+		
+		if self._xp is np:
+			return self.x
+		return self._xp.asnumpy(self.x)
+
+	def get_energy(self):
+		
+		# integral of u**2 over [0,2*pi*L] read off the current spectrum by
+		# Parseval, no inverse transform needed. One value per trajectory
+		# for a batch.
+		
+		xs = self.xspec
+		if self._xp is np and _HAVE_NUMBA:
+			e = np.empty(xs.shape[:-1])
+			_weighted_power(xs.reshape(-1,xs.shape[-1]),self._energy_w,self._energy_nyq,e.reshape(-1))
+			return e[()] if xs.ndim == 1 else e
+		e = (xs.real**2 + xs.imag**2) @ self._energy_w
+		e -= self._energy_nyq*xs[...,-1].imag**2
+		return e
+
+	def accumulate_power(self,vspec):
+		
+		# vspec += |xspec|**2, the running sum behind a time-averaged power
+		# spectrum; vspec is an array of the backend shaped like xspec. The
+		# numba kernel takes contiguous float64 only, anything else (or no
+		# numba) goes through the numpy expression.
+		
+		xs = self.xspec
+		if (self._xp is np and _HAVE_NUMBA and vspec.shape == xs.shape
+		        and vspec.dtype == np.float64 and vspec.flags.c_contiguous):
+			_accumulate_power(vspec.reshape(-1,xs.shape[-1]),xs.reshape(-1,xs.shape[-1]))
+		else:
+			vspec += xs.real**2 + xs.imag**2
+		return vspec
 
 	def plot_spectrum(self,u):
 
-		sp = np.sum(abs(np.fft.fft(u)),0)
+		# |fft| is symmetric for real u, so the k >= 0 half from rfft has the
+		# same maximum; normalise in place rather than through sp/max(sp).
+		sp = np.sum(np.abs(scipy.fft.rfft(u,axis=-1,workers=self.workers)),0)
+		sp_max = sp.max()
+		if sp_max > 0:
+			sp *= 1.0/sp_max
 		k = self.wavenums
 	
+		# pylab is only needed here; importing it lazily keeps it out of
+		# "import KS" (and of every run_ensemble worker).
+		import pylab as pl
 		pl.figure(1)
-		pl.semilogy(k[:-1],sp[0:len(k)-1]/max(sp),"r--",lw = 3)
+		pl.semilogy(k[:-1],sp[0:len(k)-1],"r--",lw = 3)
 		pl.xlabel("k",fontsize=12)
 		pl.ylim([1e-4,1.2])
 		pl.show()
-		
 
-		
 
+class KSBatch(KS):
+	#
+	# B independent trajectories of the same KS model, stepped in lockstep.
+	# x has shape (B,N) and xspec (B,N/2+1); every transform is a single
+	# batched rfft/irfft along the contiguous last axis, while ik, lin and
+	# the RK3 propagators broadcast over the batch.
+	
+	def __init__(self,L=16,N=128,dt=0.5,diffusion=1.0,initial_conditions=(),**kwargs):
 		
-
+		xx = np.linspace(0,L,N)
+		x0 = np.array([_initial_state(ic,xx,L,N) for ic in initial_conditions])
+		if x0.ndim != 2 or x0.shape[1] != N:
+			raise ValueError("initial_conditions must be a list of names or arrays of length N=%d" % N)
 		
+		KS.__init__(self,L=L,N=N,dt=dt,diffusion=diffusion,initial_condition=x0,**kwargs)
 
 
+def _run_ic(args):
+	
+	ic,n_trans,n_rec,kwargs = args
+	ks = KS(initial_condition=ic,**kwargs)
+	initial = ks.x.copy()
+	ks.step_n(n_trans)
+	energies = np.empty(n_rec)
+	ks.step_n(n_rec,energies)
+	return ks.xx,initial,energies
 
-
-
-
-
-
-
-
-
+def run_ensemble(initial_conditions,n_trans=500,n_rec=200,n_jobs=None,**kwargs):
+	#
+	# Independent KS runs, one per initial condition, spread over n_jobs
+	# worker processes (default: one per core). kwargs go to KS. Returns
+	# a list of (xx, initial state, energy after each recorded step).
+	# For many short runs in lockstep KSBatch is usually cheaper.
+	# Named initial conditions are built here, not in the workers: forked
+	# workers share the parent's np.random state, so 'random' would repeat.
+	# Each process is one core, so the FFTs default to a single thread.
+	
+	kwargs.setdefault('workers',1)
+	L,N = kwargs.get('L',16),kwargs.get('N',128)
+	xx = np.linspace(0,L,N)
+	jobs = [(_initial_state(ic,xx,L,N),n_trans,n_rec,kwargs) for ic in initial_conditions]
+	with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+		return list(pool.map(_run_ic,jobs))
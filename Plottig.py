@@ -2,7 +2,10 @@ import numpy as np
 from KS import KS
 import pylab as pl
 import matplotlib.animation as animation
+import shutil
 import sys
+import os
+import time
 
 L   = int(sys.argv[1])/(2*np.pi)  # domain is 0 to 2.*np.pi*L
 N   = int(sys.argv[1])      # number of collocation points
@@ -15,60 +18,94 @@ x = np.arange(N)*(L/N)
 
 n = 1000
 nmin=500
-uu = [] 
-tt = []
-vspec = np.zeros(ks.xspec.shape[0], np.float)
+nsub = 1           # model steps per animation frame
+# history preallocated for all n frames and filled by row; nrec counts the
+# frames actually drawn in case the window is closed early.
+uu = np.empty((n, N))
+tt = np.empty(n)
+nrec = 0
+vspec = np.zeros(ks.xspec.shape, np.float64)
 #x = np.arange(N)
 
 fig, ax = pl.subplots(1)
 line, = ax.plot(x, ks.x.squeeze(),lw=5)
 ax.set_xlim(0,L)
 ax.set_ylim(-5,5)
+ax.set_xlabel('X')
+ax.set_ylabel('u')
+# the time stamp is an artist of its own so it is redrawn by blitting,
+# a pl.title() call per frame is not part of the blitted artists. Blitting
+# only restores and redraws ax.bbox, so the text has to sit inside the axes.
+time_fmt = 'Time = %g'
+time_text = ax.text(0.02, 0.95, '', transform=ax.transAxes, animated=True)
 
 #Init only required for blitting to give a clean slate.
 
 def init():
     global line
     line.set_ydata(np.ma.array(x, mask=True))
-    return line,
-
-# cut off the transient
-for n in range(nmin):
-    ks.step()
+    time_text.set_text('')
+    return line, time_text
+
+# cut off the transient, timing it to pick the frame interval: no faster
+# than 40 fps, but never shorter than the nsub steps of a frame.
+t0 = time.perf_counter()
+ks.step_n(nmin)
+interval = max(25, int(1000*nsub*(time.perf_counter()-t0)/nmin))
+
+# bound methods and the frame time step looked up once, not on every frame
+step_n = ks.step_n
+accumulate_power = ks.accumulate_power
+set_ydata = line.set_ydata
+set_text = time_text.set_text
+dt_frame = nsub*dt
 
 def updatefig(n):
     
-	global tt,uu,vspec
-	ks.step()
-	vspec += np.abs(ks.xspec.squeeze())**2
+	global nrec
+	step_n(nsub)
+	accumulate_power(vspec)
 	u = ks.x.squeeze()
-	line.set_ydata(u)
-	pl.title('Time = ' + str(n*dt))	
-	pl.xlabel('X')
-	pl.ylabel('u')	
+	set_ydata(u)
+	t = n*dt_frame
+	set_text(time_fmt % t)
 
-	print(n)
+	if n % 100 == 0:
+		print(n)
 	
-	uu.append(u) 
-	tt.append(n*dt)
-	return line,
-
-ani = animation.FuncAnimation(fig, updatefig, np.arange(1,n+1), init_func=init,interval=25, blit=True,repeat=False)
-#ani.save('KS_animation.mp4', fps=40, extra_args=['-vcodec', 'libx264'])
-#ani.save('KS_animation.mp4', fps=40)
-
-pl.show()
+	uu[nrec] = u
+	tt[nrec] = t
+	nrec += 1
+	return line, time_text
+
+ani = animation.FuncAnimation(fig, updatefig, np.arange(1,n+1), init_func=init,interval=interval, blit=True,repeat=False)
+
+if len(sys.argv) > 2:
+    # export instead of showing: H.264 through ffmpeg encodes far faster and
+    # smaller than a gif, which is only the fallback when ffmpeg is missing.
+    fname = sys.argv[2]
+    if shutil.which('ffmpeg'):
+        writer = animation.FFMpegWriter(fps=40, codec='libx264',
+                                        extra_args=['-preset', 'fast', '-pix_fmt', 'yuv420p'])
+    else:
+        fname = os.path.splitext(fname)[0] + '.gif'
+        writer = animation.PillowWriter(fps=40)
+    ani.save(fname, writer=writer)
+    # save() leaves the animation hooked to the figure's draw event, so the
+    # pl.show() below would start it again and step ks past the n frames.
+    pl.close(fig)
+else:
+    pl.show()
 
 pl.figure(2)
 
 # make contour plot of solution, plot spectrum.
 
-ncount = len(uu)
-vspec = vspec/ncount
-uu = np.array(uu) 
-tt = np.array(tt)
+vspec /= nrec
+uu = uu[:nrec]
+tt = tt[:nrec]
 
-pl.contourf(x,tt[:n],uu[:n],1001,cmap=pl.cm.magma)
+pl.contourf(x,tt,uu,1001,cmap=pl.cm.magma)
 pl.xlabel('x')
 pl.ylabel('t')
 pl.colorbar()